@@ -1,16 +1,33 @@
 import streamlit as st
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, WriteConcern
+from pymongo.errors import ExecutionTimeout, ServerSelectionTimeoutError
 from pydantic import BaseModel
-from openai import OpenAI
-from pdfminer.high_level import extract_text
-import json
-import io
+from openai import OpenAI, AsyncOpenAI
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pdf_text import extract_for_ai
+import multiprocessing
+import tiktoken
+import asyncio
+import hashlib
+import orjson
+import os
 import re
+import time
 
 # -----------------------------
 # 기본 설정
 
 MODEL_GPT = "gpt-5-mini"
+LLM_CONCURRENCY = 10   # 동시에 보낼 최대 AI 요청 수 (rate limit 보호)
+AI_MAX_RETRIES = 5     # rate limit(429)·서버 오류 시 SDK 자동 재시도 횟수 (지수 백오프)
+PROGRESS_EVERY_CHARS = 2_000  # 스트리밍 진행 표시 갱신 간격 (수신 글자 수)
+PROGRESS_EVERY_SEC = 0.5      # 스트리밍 진행 표시 갱신 간격 (초)
+MAX_INPUT_TOKENS = 120_000   # 프롬프트에 넣을 문서 본문 최대 토큰 수
+ROW_BATCH_TOKENS = 8_000     # 작은 문서를 한 요청에 묶을 때 본문 토큰 합계 상한
+ROW_BATCH_MAX_DOCS = 8       # 한 요청에 묶을 최대 문서 수
+FOCUS_MIN_CHARS = 20_000     # 이보다 긴 본문만 감사결과 관련 부분으로 줄임
+PREVIEW_CHARS = 8000         # 원문 미리보기 글자 수 (너무 길면 브라우저가 멈춤)
 # -----------------------------
 st.set_page_config(layout="wide", page_title="감사결과 PDF 파일 파싱 서비스")
 st.title("감사결과 PDF 자동 구조화 시스템")
@@ -54,10 +71,234 @@ if not OPENAI_API_KEY or not MONGO_URI:
 # -----------------------------
 # 클라이언트 설정
 # -----------------------------
-client = OpenAI(api_key=OPENAI_API_KEY)
-mongo_client = MongoClient(MONGO_URI)
+# 스크립트는 위젯 조작마다 처음부터 재실행되므로, 커넥션 풀·TLS 연결을 가진
+# 클라이언트는 프로세스당 한 번만 만들어 재사용
+@st.cache_resource
+def get_openai() -> OpenAI:
+    return OpenAI(api_key=OPENAI_API_KEY)
+
+@st.cache_resource
+def get_mongo() -> MongoClient:
+    # 관련규정 원문 등 텍스트가 큰 문서가 많아 와이어 압축을 켬
+    # (서버와 협상해 지원되는 첫 방식 사용, zlib은 추가 패키지 없이 가능한 대안)
+    return MongoClient(
+        MONGO_URI,
+        maxPoolSize=50,
+        # 서버에 닿지 않으면 기본 30초 대신 5초 만에 실패 (첫 서버 호출인 ensure_indexes에서 안내)
+        serverSelectionTimeoutMS=5000,
+        compressors="zstd,snappy,zlib",
+        zlibCompressionLevel=-1,
+    )
+
+client = get_openai()
+mongo_client = get_mongo()
 db = mongo_client["json_db"]
 collection = db["Yangsan_Audit"]
+# 대량 저장용: 프라이머리 1곳 확인(저널 대기 없음)만 받고 바로 반환
+ingest_collection = collection.with_options(write_concern=WriteConcern(w=1, j=False))
+
+# 문서 _id는 원본 PDF 바이트의 SHA-256 (같은 파일을 다시 올려도 중복 저장·재분석하지 않음)
+def stored_hashes(hashes) -> set[str]:
+    return set(collection.distinct("_id", {"_id": {"$in": list(hashes)}}))
+
+def save_documents(docs: list[dict]) -> int:
+    # 이미 있는 _id면 $setOnInsert가 아무것도 쓰지 않음. 새로 저장된 건수를 반환
+    result = ingest_collection.bulk_write(
+        [
+            UpdateOne(
+                {"_id": d["_id"]},
+                {"$setOnInsert": {k: v for k, v in d.items() if k != "_id"}},
+                upsert=True,
+            )
+            for d in docs
+        ],
+        ordered=False,
+    )
+    return result.upserted_count
+
+# 검색 대상이 되는 감사결과 하위 필드
+SEARCH_FIELDS = ("건명", "처분", "관련규정", "지적사항")
+
+def build_search_blob(doc: dict) -> str:
+    # 저장 시 감사결과 검색 필드를 소문자로 이어 붙여 두어(_search_blob)
+    # 포함 검색이 필드 4개 × 대소문자 무시 정규식 대신 필드 하나만 보도록 함
+    return " ".join(
+        " ".join(r.get(field) or "" for field in SEARCH_FIELDS)
+        for r in doc.get("감사결과") or []
+    ).lower()
+
+# 검색 결과 최대 건수
+SEARCH_LIMIT = 100
+RESULTS_PER_PAGE = 20       # 검색 결과 한 페이지에 표시할 문서 수
+TEXT_CANDIDATE_LIMIT = 200  # 단어 검색 결과 최대 문서 수 (관련도 높은 순)
+SEARCH_MAX_TIME_MS = 2000   # 검색 한 번에 서버가 쓸 수 있는 최대 시간
+
+def matching_items(regex: str, options: str = "") -> dict:
+    # 감사결과 배열에서 검색 필드 중 하나라도 정규식에 맞는 항목만 남기는 $filter 식
+    # ($elemMatch 프로젝션은 첫 번째 일치 항목 하나만 돌려주므로 사용하지 않음)
+    return {
+        "$filter": {
+            "input": "$감사결과",
+            "as": "a",
+            "cond": {
+                "$or": [
+                    {"$regexMatch": {
+                        "input": {"$ifNull": [f"$$a.{field}", ""]},
+                        "regex": regex,
+                        "options": options,
+                    }}
+                    for field in SEARCH_FIELDS
+                ]
+            },
+        }
+    }
+
+def search_terms_pattern(search_query: str) -> str | None:
+    # $text 검색어에서 실제로 찾는 단어만 추려(따옴표 제거, "-단어" 제외 조건은 무시)
+    # 서버의 $regexMatch에 넘길 이스케이프된 대안(|) 패턴 문자열로 만듦
+    terms = [
+        term.strip('"')
+        for term in search_query.split()
+        if not term.startswith("-") and term.strip('"')
+    ]
+    if not terms:
+        return None
+    return "|".join(map(re.escape, terms))
+
+def find_matching_items(match: dict, regex: str, options: str = "",
+                        sort: dict | None = None, limit: int = SEARCH_LIMIT):
+    # 문서 선택과 항목 필터링을 모두 서버에서 처리해 일치 항목만 전송받음
+    pipeline = [{"$match": match}]
+    if sort:
+        pipeline.append({"$sort": sort})
+    pipeline += [
+        {"$project": {
+            "감사연도": 1,
+            "피감기관": 1,
+            "_id": 0,
+            "감사결과": matching_items(regex, options),
+        }},
+        # 걸러낸 뒤 남은 항목이 없는 문서는 보내지 않음
+        {"$match": {"감사결과.0": {"$exists": True}}},
+        # 상한보다 한 건 더 받아 결과가 잘렸는지 판단 (파이프라인은 필요한 만큼만 읽음)
+        {"$limit": limit + 1},
+    ]
+    docs = list(collection.aggregate(pipeline, maxTimeMS=SEARCH_MAX_TIME_MS))
+    return docs[:limit], len(docs) > limit
+
+def search_prefix(search_query: str):
+    # ^ 앵커 + 이스케이프 + 대소문자 구분이어야 MongoDB가 인덱스 범위 스캔을 사용
+    pattern = "^" + re.escape(search_query)
+    return find_matching_items(
+        {
+            "감사결과": {
+                "$elemMatch": {
+                    "$or": [
+                        {field: {"$regex": pattern}}
+                        for field in SEARCH_FIELDS
+                    ]
+                }
+            }
+        },
+        pattern,
+    )
+
+def search_substring(search_query: str):
+    # 미리 소문자로 만들어 둔 _search_blob 한 필드만 대소문자 구분 정규식으로 조회
+    # (소문자 변환 후 정규식 특수문자가 깨지지 않도록 이스케이프)
+    return find_matching_items(
+        {"_search_blob": {"$regex": re.escape(search_query.lower())}},
+        re.escape(search_query),
+        "i",
+    )
+
+def search_text(search_query: str):
+    # 텍스트 인덱스(역색인)로 후보 문서를 관련도 순으로 추린 뒤,
+    # 실제로 검색어가 들어 있는 감사결과 항목만 서버에서 걸러 받음
+    # ($text는 문서 단위로만 일치 여부를 알려줌)
+    pattern = search_terms_pattern(search_query)
+    return find_matching_items(
+        {"$text": {"$search": search_query}},
+        pattern or "",
+        "i",
+        sort={"score": {"$meta": "textScore"}},
+        limit=TEXT_CANDIDATE_LIMIT,
+    )
+
+def collect_matches(results: tuple[list, bool]) -> tuple[int, list, bool]:
+    # 서버가 이미 일치 항목만 돌려주므로 건수만 세어 표시용으로 묶음
+    docs, truncated = results
+    display_blocks = [(doc, doc["감사결과"]) for doc in docs]
+    return sum(len(items) for _, items in display_blocks), display_blocks, truncated
+
+# 같은 검색어로 다시 그릴 때(다른 위젯 조작 등)는 DB를 다시 조회하지 않음
+# 저장 후에는 run_search.clear()로 비움. 시간 초과(예외)는 캐시되지 않음
+# 반환값: (일치 항목 수, 표시용 묶음, 문서 상한으로 잘렸는지, 부분 일치로 대체 검색했는지)
+@st.cache_data(ttl=300, show_spinner=False)
+def run_search(search_query: str, search_mode: str) -> tuple[int, list, bool, bool]:
+    if search_mode == "접두":
+        return *collect_matches(search_prefix(search_query)), False
+    if search_mode == "포함":
+        return *collect_matches(search_substring(search_query)), False
+    matches = collect_matches(search_text(search_query))
+    if matches[1]:
+        return *matches, False
+    # 조사가 붙은 단어 등 토큰이 정확히 일치하지 않는 경우에만 부분 일치로 재검색
+    return *collect_matches(search_substring(search_query)), True
+
+# -----------------------------
+# MongoDB 인덱스 (프로세스당 1회)
+# -----------------------------
+meta_collection = db["app_meta"]
+SEARCH_BLOB_BACKFILL_ID = "search_blob_backfill"
+BACKFILL_BATCH_SIZE = 500
+
+def backfill_search_blobs():
+    # _search_blob 도입 전에 저장된 문서는 포함 검색에 걸리지 않으므로 한 번 채워 넣음
+    # 서버의 $toLower는 ASCII 밖의 대문자(전각 영문·그리스·키릴 문자 등)를 확실히 바꾸지 못해
+    # 검색어(파이썬 lower())와 어긋나므로, 저장 시와 같은 build_search_blob으로 파이썬에서 계산
+    # (예전에 서버에서 $toLower로 채운 값도 바로잡도록 모든 문서를 다시 계산)
+    # 새 문서는 항상 _search_blob과 함께 저장되므로 끝나면 표시를 남겨,
+    # 이후 시작 때마다 컬렉션 전체를 훑지 않도록 함
+    if meta_collection.find_one({"_id": SEARCH_BLOB_BACKFILL_ID}, {"_id": 1}):
+        return
+    requests = []
+    for doc in collection.find({}, {"감사결과": 1}):
+        requests.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"_search_blob": build_search_blob(doc)}}))
+        if len(requests) >= BACKFILL_BATCH_SIZE:
+            collection.bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+    meta_collection.update_one({"_id": SEARCH_BLOB_BACKFILL_ID}, {"$set": {"done": True}}, upsert=True)
+
+@st.cache_resource
+def ensure_indexes():
+    # 접두 일치(^) 검색이 컬렉션 전체 스캔 대신 인덱스 범위 스캔을 쓰도록
+    # create_index는 멱등이므로 이미 있으면 아무 일도 하지 않음
+    for field in SEARCH_FIELDS:
+        collection.create_index([(f"감사결과.{field}", 1)])
+
+    # 일반 검색용 전문(텍스트) 인덱스. 한국어는 MongoDB 형태소 분석 대상이 아니므로
+    # default_language="none"으로 어간 추출 없이 토큰 그대로 색인
+    collection.create_index(
+        [(f"감사결과.{field}", "text") for field in SEARCH_FIELDS],
+        default_language="none",
+        name="audit_text",
+    )
+
+    # 연도·기관별 조회/정렬용 복합 인덱스 (감사연도 단독 범위 조건에도 사용 가능)
+    collection.create_index([("감사연도", 1), ("피감기관", 1)])
+
+    # 텍스트 인덱스는 컬렉션당 하나뿐이라 _search_blob에는 따로 만들지 않음
+    backfill_search_blobs()
+
+# 첫 서버 호출이므로 여기서 연결 실패를 잡아 안내하고 멈춤 (실패는 캐시되지 않아 다음 실행에서 재시도)
+try:
+    ensure_indexes()
+except ServerSelectionTimeoutError:
+    st.error("MongoDB 서버에 연결할 수 없습니다. MONGO_URI와 네트워크(IP 접근 허용 목록 등)를 확인하세요.")
+    st.stop()
 
 # -----------------------------
 # Pydantic 모델
@@ -74,78 +315,474 @@ class ResearchPaperExtraction(BaseModel):
     피감기관: str
     감사결과: list[AuditResult]
 
+def _strict_json_schema(schema):
+    # OpenAI structured outputs(strict) 규칙에 맞게 변환:
+    # 모든 객체는 additionalProperties=false, 모든 필드 required, default 키워드 불가
+    if isinstance(schema, list):
+        return [_strict_json_schema(v) for v in schema]
+    if not isinstance(schema, dict):
+        return schema
+    schema = {k: _strict_json_schema(v) for k, v in schema.items() if k != "default"}
+    if schema.get("type") == "object" and "properties" in schema:
+        schema["required"] = list(schema["properties"])
+        schema["additionalProperties"] = False
+    return schema
+
+# 작은 문서 여러 건을 한 번의 요청으로 구조화할 때의 응답 형태
+# doc: 결과가 어느 문서(---DOC n---의 n) 것인지. 배열 순서만 믿지 않고 이 번호로 파일과 맞춤
+class MarshaledExtraction(ResearchPaperExtraction):
+    doc: int
+
+class BatchExtraction(BaseModel):
+    documents: list[MarshaledExtraction]
+
+def _response_format(name: str, model: type[BaseModel]) -> dict:
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "schema": _strict_json_schema(model.model_json_schema()),
+            "strict": True,
+        },
+    }
+
+# 즉시 처리·Batch API 요청에 공통으로 쓰는 response_format (모듈 로드 시 1회 생성)
+AUDIT_RESPONSE_FORMAT = _response_format("audit_report", ResearchPaperExtraction)
+BATCH_RESPONSE_FORMAT = _response_format("audit_report_batch", BatchExtraction)
+
 # -----------------------------
 # PDF 텍스트 추출 함수
 # -----------------------------
-def extract_text_from_pdf(file):
-    if hasattr(file, "read"):
-        data = file.read()
-        file.seek(0)
-        return extract_text(io.BytesIO(data))
-    return extract_text(file)
+# 추출은 CPU 작업이라 GIL을 피하도록 별도 프로세스에서 실행
+# (Streamlit 서버는 멀티스레드이므로 fork 대신 spawn 사용)
+@st.cache_resource
+def get_pdf_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=min(4, os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
 
-# -----------------------------
-# 텍스트 정제 함수 (표·연번 제거)
-# -----------------------------
-def clean_text_for_ai(text: str) -> str:
-    lines = text.splitlines()
-    cleaned = []
+# 시간 제한으로 일부 페이지를 읽지 못한 추출 결과
+# 예외로 돌려보내 st.cache_data에 완성된 결과처럼 캐시되지 않게 함
+class IncompleteExtraction(Exception):
+    def __init__(self, preview: str, text: str, skipped_pages: list[int]):
+        super().__init__("일부 페이지를 읽지 못했습니다")
+        self.preview = preview
+        self.text = text
+        self.skipped_pages = skipped_pages
 
-    for line in lines:
-        raw = line
-        line = line.rstrip("\n")
+# 위젯 조작마다 스크립트가 재실행되므로, 같은 파일(바이트 해시 기준)은 한 번만 추출
+# 반환값: (원문 미리보기, 정제된(긴 문서는 감사결과 부분만 추린) 본문)
+# 일부 페이지를 읽지 못하면 IncompleteExtraction (캐시하지 않음)
+# 큰 문서의 본문이 서버 메모리에 계속 쌓이지 않도록 보관 기간·개수를 제한
+@st.cache_data(show_spinner=False, ttl=24 * 60 * 60, max_entries=32)
+def _extract_cached(pdf_bytes: bytes) -> tuple[str, str]:
+    # 워커 하나가 죽으면(MuPDF 충돌·메모리 부족 등) 풀 전체가 BrokenProcessPool이 되므로
+    # 캐시된 풀을 버리고 새 풀로 한 번 더 시도
+    for attempt in range(2):
+        pool = get_pdf_pool()
+        try:
+            preview, text, skipped_pages = pool.submit(
+                extract_for_ai, pdf_bytes, PREVIEW_CHARS, FOCUS_MIN_CHARS
+            ).result()
+            break
+        except BrokenProcessPool:
+            pool.shutdown(wait=False)
+            get_pdf_pool.clear()
+            if attempt:
+                raise
+    if skipped_pages:
+        raise IncompleteExtraction(preview, text, skipped_pages)
+    return preview, text
 
-        # 1) 완전한 구분선(테이블 테두리 등) 제거
-        #    ─, │, ┃, ┏, ┓, ┗, ┛, =, - 등으로만 이루어진 줄
-        if re.match(r"^[\s│┃┏┓┗┛━═\-_=]+$", line):
-            continue
+def extract_document(pdf_bytes: bytes) -> tuple[str, str, list[int]]:
+    # 반환값: (원문 미리보기, 본문, 건너뛴 페이지 번호)
+    try:
+        return *_extract_cached(pdf_bytes), []
+    except IncompleteExtraction as e:
+        return e.preview, e.text, e.skipped_pages
 
-        stripped = line.strip()
+# 건너뛴 페이지 번호 표시용 (예: "3, 7쪽")
+def page_list(pages: list[int]) -> str:
+    return ", ".join(map(str, pages)) + "쪽"
 
-        # 2) 완전히 비어 있는 줄은 건너뛰기
-        if not stripped:
-            continue
+async def _extract_all(pdf_bytes_list: list[bytes]) -> list[tuple[str, str, list[int]] | Exception]:
+    # 파일마다 스레드에서 캐시를 조회하고, 캐시에 없으면 프로세스 풀에서 동시에 추출
+    # 읽을 수 없는 파일 하나 때문에 나머지가 버려지지 않도록 예외는 결과 자리에 담아 돌려줌
+    return await asyncio.gather(
+        *(asyncio.to_thread(extract_document, data) for data in pdf_bytes_list),
+        return_exceptions=True,
+    )
 
-        # 3) 페이지 번호 형식 제거 (예: "- 15 -", "15 / 32" 등)
-        if re.match(r"^[\-–—\s]*\d+\s*/\s*\d+[\-–—\s]*$", stripped):
-            continue
-        if re.match(r"^[\-–—\s]*\d+[\-–—\s]*$", stripped) and len(stripped) <= 8:
-            # 짧은 페이지 번호 형태(예: "- 15 -", "15")만 제거
+def file_digest(f) -> str:
+    # 추출 완료를 기다리는 재실행마다 큰 PDF 전체를 다시 해시하지 않도록
+    # 업로드 단위(file_id)로 SHA-256을 보관
+    digests = st.session_state["upload_digests"]
+    if f.file_id not in digests:
+        digests[f.file_id] = hashlib.sha256(f.getvalue()).hexdigest()
+    return digests[f.file_id]
+
+def unique_pdfs(files) -> dict:
+    # 같은 PDF를 여러 번 올린 경우 내용 해시 기준으로 한 건만 남김 (해시 → 업로드 파일)
+    unique = {}
+    for f in files:
+        unique.setdefault(file_digest(f), f)
+    return unique
+
+def extract_texts(files) -> tuple[list[dict], list[tuple[str, Exception]]]:
+    # 반환값: (추출한 문서 목록, 추출에 실패한 (파일명, 예외) 목록)
+    unique = unique_pdfs(files)
+    results = asyncio.run(_extract_all([f.getvalue() for f in unique.values()]))
+    documents, failed = [], []
+    for (digest, f), result in zip(unique.items(), results):
+        if isinstance(result, Exception):
+            failed.append((f.name, result))
             continue
+        preview, text, skipped_pages = result
+        documents.append({
+            "name": f.name, "hash": digest, "preview": preview, "text": text, "skipped_pages": skipped_pages,
+        })
+    return documents, failed
+
+# 업로드 화면에서는 추출을 기다리며 스크립트를 멈추지 않도록 백그라운드 스레드에서
+# 캐시 조회·프로세스 풀 대기를 하고, 스크립트는 완료 여부만 확인
+@st.cache_resource
+def get_extract_threads() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
 
-        # 4) 표 캡션 제거 (예: "표 1", "표 2-1", "Table 1" 등)
-        if re.match(r"^표\s*\d+([\--–]\d+)?", stripped):
+def start_extraction(files) -> tuple[list[dict], int]:
+    # 아직 시작하지 않은 파일만 추출을 맡기고, (끝난 문서 목록, 진행 중인 파일 수)를 반환
+    jobs = st.session_state["extract_jobs"]
+    unique = unique_pdfs(files)
+    for digest in [d for d in jobs if d not in unique]:
+        jobs[digest].cancel()
+        del jobs[digest]
+
+    documents, pending = [], 0
+    for digest, f in unique.items():
+        name = f.name
+        if digest not in jobs:
+            jobs[digest] = get_extract_threads().submit(extract_document, f.getvalue())
+        future = jobs[digest]
+        if not future.done():
+            pending += 1
             continue
-        if "table" in stripped.lower():
+        try:
+            preview, text, skipped_pages = future.result()
+        except Exception as e:
+            # 실패한 작업은 지워 두어 다음 실행(재업로드·위젯 조작)에서 다시 시도
+            del jobs[digest]
+            st.error(f"{name}: PDF 텍스트 추출 중 오류 발생: {e}")
             continue
+        documents.append({
+            "name": name, "hash": digest, "preview": preview, "text": text, "skipped_pages": skipped_pages,
+        })
+    return documents, pending
 
-        # 5) 리스트 번호 같은 "1.", "2)", "3. 가)" 형태는 제거하되
-        #    실제 제목/건명 줄은 절대 삭제하지 않기
-        #
-        #   - 예) "1." / "2)" / "3. 가)" 처럼 숫자+기호만 있고 내용이 거의 없는 경우만 제거
-        #
-        if re.match(r"^\d{1,2}\s*[.)]\s*$", stripped):
-            # 내용 없는 순번만 있는 줄 (예: "1." / "2)")
-            continue
-        if re.match(r"^\d{1,2}\s*[.)]\s*[가-힣]\s*$", stripped):
-            # 예: "1. 가" "2) 나" 같은 순번+한 글자만 있는 줄
+@st.cache_resource
+def get_encoder():
+    # gpt-4o / gpt-5 계열 토크나이저
+    return tiktoken.get_encoding("o200k_base")
+
+@st.cache_data(show_spinner=False)
+def truncate_to_tokens(text: str, max_tokens: int = MAX_INPUT_TOKENS) -> str:
+    # 토큰 수는 UTF-8 바이트 수를 넘지 않으므로 짧은 문서는 인코딩 없이 통과
+    if len(text.encode("utf-8")) <= max_tokens:
+        return text
+    # 앞부분(감사연도·피감기관 등 머리말)을 살리고 뒤를 자름
+    tokens = get_encoder().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return get_encoder().decode(tokens[:max_tokens])
+
+def prepare_for_ai(text: str) -> str:
+    # 정제와 긴 문서의 감사결과 부분 추리기는 추출 단계(extract_for_ai, 워커 프로세스)에서 이미 끝남
+    return truncate_to_tokens(text)
+
+
+# -----------------------------
+# AI 구조화 함수
+# -----------------------------
+SYSTEM_PROMPT = (
+    "You are an expert in Korean audit report parsing. "
+    "You must convert unstructured text into structured JSON according to the schema."
+)
+
+EXTRACTION_RULES = (
+    "다음 조건을 지켜 감사결과를 JSON으로 구조화하세요:\n"
+    "1) 상위 제목과 세부 제목을 구분하세요.\n"
+    "   - '○○ 분야', '건강관리 분야', '예산·회계 분야'처럼 '분야'로 끝나는 것은 **분야**입니다.\n"
+    "   - '15 ○○○○센터 비품관리대장 관리 소홀 [시정]'처럼 번호 + 제목 + [처분] 형태는\n"
+    "     번호를 제외한 부분을 **건명**으로 사용합니다.\n"
+    "2) JSON 필드는 다음과 같습니다.\n"
+    "   - '분야': '예산·회계', '건강관리', '보건위생' 등 상위 분야 이름(예: '건강관리 분야' → '건강관리').\n"
+    "   - '건명': 각 지적사항의 구체적인 제목\n"
+    "       예) '특별휴가 사용 관리 소홀', '○○센터 비품관리대장 관리 소홀' 등.\n"
+    "       '예산·회계 분야', '건강관리 분야'처럼 상위 제목은 건명에 절대 넣지 마세요.\n"
+    "   - '처분': '시정', '주의', '통보', '시정/주의/통보' 등.\n"
+    "   - '관련규정': 해당 지적사항 아래 '관련규정' 항목 전체 (요약 금지).\n"
+    "   - '지적사항': 해당 지적사항 아래 '지적사항' 및 '조치할 사항' 내용을 자연스럽게 연결한 문단.\n"
+    "3) JSON 전체 구조는 다음과 같습니다.\n"
+    "{ '감사연도': str,\n"
+    "  '피감기관': str,\n"
+    "  '감사결과': [\n"
+    "    { '분야': str, '건명': str, '처분': str, '관련규정': str, '지적사항': str }, ...\n"
+    "  ]\n"
+    "}\n"
+)
+
+# 고정 지시문(시스템 프롬프트 + 추출 규칙)을 항상 맨 앞에 같은 내용으로 두어
+# 모든 요청이 같은 접두부를 공유하게 함 → OpenAI 자동 프롬프트 캐싱으로 그 부분은 할인·빠르게 처리
+# 문서마다 달라지는 본문은 그 뒤(user 메시지)에만 둔다
+SYSTEM_MESSAGE = {"role": "system", "content": f"{SYSTEM_PROMPT}\n\n{EXTRACTION_RULES}"}
+
+def build_messages(text: str) -> list[dict]:
+    return [SYSTEM_MESSAGE, {"role": "user", "content": text}]
+
+def build_marshaled_messages(texts: list[str]) -> list[dict]:
+    # 여러 문서를 ---DOC n--- 구분자로 이어 붙여 한 번에 요청
+    docs = "".join(f"---DOC {i}---\n{text}\n" for i, text in enumerate(texts, start=1))
+    return [
+        SYSTEM_MESSAGE,
+        {
+            "role": "user",
+            "content": (
+                f"{docs}\n"
+                f"위에는 '---DOC n---'으로 구분된 문서 {len(texts)}건이 있습니다.\n"
+                "'documents' 배열에 문서 순서대로, 문서마다 하나씩 지시된 구조의 결과를 넣고\n"
+                "각 결과의 'doc'에는 해당 문서 번호 n을 넣으세요.\n"
+            ),
+        },
+    ]
+
+@st.cache_data(show_spinner=False)
+def count_tokens(text: str) -> int:
+    return len(get_encoder().encode(text))
+
+def group_for_marshaling(texts: list[str]) -> list[list[int]]:
+    # 작은 문서들은 요청당 고정 지연을 나눠 내도록 묶고, 큰 문서는 단독으로 요청
+    groups, current, current_tokens = [], [], 0
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text)
+        if tokens > ROW_BATCH_TOKENS:
+            groups.append([i])
             continue
+        if current and (current_tokens + tokens > ROW_BATCH_TOKENS or len(current) >= ROW_BATCH_MAX_DOCS):
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+async def _complete_json(aclient: AsyncOpenAI, semaphore: asyncio.Semaphore, messages, response_format,
+                         on_progress=None) -> dict:
+    # 응답을 스트리밍으로 받아 긴 문서도 진행 상황(수신 글자 수)을 바로 보여줌
+    # 델타(대략 토큰 하나)마다 화면을 갱신하면 웹소켓 메시지가 폭증하므로
+    # PROGRESS_EVERY_CHARS 글자 이상 늘었거나 PROGRESS_EVERY_SEC초가 지났을 때만 알림
+    content, refusal = [], []
+    received = reported = 0
+    reported_at = time.monotonic()
+    async with semaphore:
+        stream = await aclient.chat.completions.create(
+            model=MODEL_GPT,
+            messages=messages,
+            response_format=response_format,
+            stream=True,
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.refusal:
+                refusal.append(delta.refusal)
+            if delta.content:
+                content.append(delta.content)
+                received += len(delta.content)
+                now = time.monotonic()
+                if on_progress and (
+                    received - reported >= PROGRESS_EVERY_CHARS
+                    or now - reported_at >= PROGRESS_EVERY_SEC
+                ):
+                    on_progress(received)
+                    reported, reported_at = received, now
+    # strict 스키마로 서버가 형식을 보장하므로 pydantic 검증 없이 dict로 바로 사용
+    if refusal:
+        raise ValueError(f"모델이 응답을 거부했습니다: {''.join(refusal)}")
+    return orjson.loads("".join(content))
+
+async def parse_one(aclient: AsyncOpenAI, semaphore: asyncio.Semaphore, text: str, on_progress=None) -> dict:
+    # 429·5xx·연결 오류는 SDK가 지수 백오프로 재시도(max_retries)하고,
+    # 여기서는 응답이 잘려 JSON이 깨진 경우만 한 번 더 요청
+    messages = build_messages(text)
+    try:
+        return await _complete_json(aclient, semaphore, messages, AUDIT_RESPONSE_FORMAT, on_progress)
+    except orjson.JSONDecodeError:
+        return await _complete_json(aclient, semaphore, messages, AUDIT_RESPONSE_FORMAT, on_progress)
+
+async def parse_group(aclient: AsyncOpenAI, semaphore: asyncio.Semaphore, texts: list[str],
+                      on_progress=None) -> list:
+    # 묶음 요청이 실패하거나 결과의 문서 번호가 1..n과 정확히 맞지 않으면
+    # (누락·중복 등) 다른 파일의 결과가 섞여 저장되지 않도록 문서별 요청으로 다시 처리
+    # on_progress(k, 수신 글자 수)의 k는 묶음 안에서의 순번
+    def report(ks):
+        if not on_progress:
+            return None
+        def callback(received):
+            for k in ks:
+                on_progress(k, received)
+        return callback
+
+    if len(texts) > 1:
+        try:
+            data = await _complete_json(
+                aclient, semaphore, build_marshaled_messages(texts), BATCH_RESPONSE_FORMAT,
+                report(range(len(texts))),
+            )
+            by_doc = {d.pop("doc"): d for d in data["documents"]}
+            expected = range(1, len(texts) + 1)
+            if len(data["documents"]) == len(texts) and set(by_doc) == set(expected):
+                return [by_doc[n] for n in expected]
+        except Exception:
+            pass
+    return await asyncio.gather(
+        *(parse_one(aclient, semaphore, text, report([k])) for k, text in enumerate(texts)),
+        return_exceptions=True,
+    )
+
+async def parse_all(texts: list[str], on_done=None, on_progress=None) -> list:
+    # 여러 PDF를 동시에 요청(네트워크 대기 시간이 겹치도록). 실패한 건은 예외 객체로 반환
+    # on_done(i, 결과)은 각 요청이 끝나는 즉시 호출되어 결과를 먼저 보여줄 수 있음
+    # on_progress(i, 수신 글자 수)는 응답이 스트리밍되는 동안 호출됨
+    # 클라이언트는 asyncio.run마다 새 이벤트 루프에 묶이므로 호출 단위로 생성·정리
+    semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    outcomes = [None] * len(texts)
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=AI_MAX_RETRIES) as aclient:
+        async def run(group: list[int]):
+            def report(k, received):
+                on_progress(group[k], received)
+
+            results = await parse_group(
+                aclient, semaphore, [texts[i] for i in group], report if on_progress else None
+            )
+            for i, outcome in zip(group, results):
+                outcomes[i] = outcome
+                if on_done:
+                    on_done(i, outcome)
 
-        # ⛔ 여기서부터는 "5. 건강관리 분야", "15 ○○센터 비품관리대장…" 같은
-        #    실제 제목/건명 줄은 그대로 유지됨
+        await asyncio.gather(*(run(group) for group in group_for_marshaling(texts)))
+    return outcomes
 
-        cleaned.append(line)
 
-    return "\n".join(cleaned)
+# 같은 파일은 모델·프롬프트·스키마·전처리 설정이 같으면 AI 결과를 다시 요청하지 않음
+# (저장 전에 새로고침하거나 다른 세션에서 같은 파일을 올린 경우 등). 프로세스 메모리에 보관
+AI_CACHE_VERSION = hashlib.sha256(orjson.dumps([
+    MODEL_GPT, SYSTEM_PROMPT, EXTRACTION_RULES, AUDIT_RESPONSE_FORMAT,
+    MAX_INPUT_TOKENS, FOCUS_MIN_CHARS,
+])).hexdigest()
+AI_CACHE_MAX_ENTRIES = 256
+
+@st.cache_resource
+def get_ai_result_cache() -> dict:
+    return {}
+
+def cached_ai_result(pdf_hash: str) -> dict | None:
+    return get_ai_result_cache().get((pdf_hash, AI_CACHE_VERSION))
+
+def remember_ai_result(pdf_hash: str, result: dict):
+    cache = get_ai_result_cache()
+    cache[(pdf_hash, AI_CACHE_VERSION)] = result
+    while len(cache) > AI_CACHE_MAX_ENTRIES:
+        cache.pop(next(iter(cache)), None)   # 가장 먼저 넣은 항목부터 제거
+
+
+# -----------------------------
+# OpenAI Batch API 일괄 처리 (비용 50%, 24시간 내 완료)
+# -----------------------------
+def build_batch_jsonl(documents: list[dict]) -> bytes:
+    # orjson은 UTF-8 바이트를 바로 만들어 주므로 줄마다 인코딩할 필요 없음
+    # 건너뛴 페이지가 있으면 결과를 저장할 때 남기도록 custom_id에 함께 실어 보냄
+    lines = []
+    for d in documents:
+        key = d["hash"]
+        if d["skipped_pages"]:
+            key += "#" + ",".join(map(str, d["skipped_pages"]))
+        lines.append(orjson.dumps({
+            "custom_id": f"{key}:{d['name']}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": MODEL_GPT,
+                "messages": build_messages(prepare_for_ai(d["text"])),
+                "response_format": AUDIT_RESPONSE_FORMAT,
+            },
+        }))
+    return b"\n".join(lines)
+
+def submit_batch(documents: list[dict]) -> str:
+    batch_file = client.files.create(
+        file=("audit_batch.jsonl", build_batch_jsonl(documents)),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+def _batch_file_rows(file_id: str | None):
+    if not file_id:
+        return
+    for line in client.files.content(file_id).text.splitlines():
+        if line.strip():
+            yield orjson.loads(line)
+
+def _batch_custom_id(row: dict) -> tuple[str, str, list[int]]:
+    # custom_id = "<파일 해시>[#<건너뛴 페이지>]:<파일명>" → (해시, 표시할 이름, 건너뛴 페이지)
+    key, _, name = row.get("custom_id", "?").partition(":")
+    digest, _, pages = key.partition("#")
+    return digest, name or digest, [int(p) for p in pages.split(",") if p.isdigit()]
+
+def load_batch_results(output_file_id: str | None, error_file_id: str | None) -> tuple[list[dict], list[str]]:
+    # 결과 JSONL을 감사결과 문서 목록으로 변환. 실패한 요청은 파일 이름만 모아서 반환
+    # 요청 단위로 실패한 건(HTTP 오류 등)은 결과 파일이 아니라 오류 파일(error_file_id)에 기록됨
+    docs, failed = [], []
+    for row in _batch_file_rows(output_file_id):
+        digest, name, skipped_pages = _batch_custom_id(row)
+        try:
+            content = row["response"]["body"]["choices"][0]["message"]["content"]
+            doc = orjson.loads(content)
+            doc["_id"] = digest
+            doc["_search_blob"] = build_search_blob(doc)
+            if skipped_pages:
+                doc["_skipped_pages"] = skipped_pages
+            docs.append(doc)
+        except (KeyError, IndexError, TypeError, ValueError):
+            failed.append(name)
+    for row in _batch_file_rows(error_file_id):
+        failed.append(_batch_custom_id(row)[1])
+    return docs, failed
 
 
 # -----------------------------
 # 세션 상태
 # -----------------------------
-if "extracted_text" not in st.session_state:
-    st.session_state["extracted_text"] = None
-if "structured_json" not in st.session_state:
-    st.session_state["structured_json"] = None
+if "documents" not in st.session_state:
+    st.session_state["documents"] = None
+if "pending_docs" not in st.session_state:
+    st.session_state["pending_docs"] = []   # 구조화됐지만 아직 저장하지 않은 문서
+if "batch_id" not in st.session_state:
+    st.session_state["batch_id"] = ""
+if "saved_batches" not in st.session_state:
+    st.session_state["saved_batches"] = set()
+if "search" not in st.session_state:
+    st.session_state["search"] = ("", "단어")   # 마지막으로 제출한 (검색어, 검색 방식)
+if "upload_digests" not in st.session_state:
+    st.session_state["upload_digests"] = {}   # 업로드 file_id → 파일 SHA-256
+if "extract_jobs" not in st.session_state:
+    st.session_state["extract_jobs"] = {}   # 파일 해시 → 추출 Future
 
 # -----------------------------
 # 레이아웃
@@ -154,127 +791,244 @@ col1, col2 = st.columns(2)
 
 # ----------- (1) 파일 업로드 -----------
 with col1:
-    uploaded_file = st.file_uploader("PDF 파일을 업로드하세요", type="pdf")
-    if uploaded_file:
-        extracted_text = extract_text_from_pdf(uploaded_file)
-        st.session_state["extracted_text"] = extracted_text
+    uploaded_files = st.file_uploader(
+        "PDF 파일을 업로드하세요", type="pdf", accept_multiple_files=True
+    )
+    extraction_pending = 0
+    if uploaded_files:
+        documents, extraction_pending = start_extraction(uploaded_files)
+        # 모든 파일의 추출이 끝나야 AI 분석을 시작할 수 있음
+        st.session_state["documents"] = None if extraction_pending else documents
+        if extraction_pending:
+            st.info(
+                f"PDF 텍스트를 추출하는 중입니다... "
+                f"({len(documents)}/{len(documents) + extraction_pending}건 완료)"
+            )
 
+    if uploaded_files and documents:
         st.subheader("📄 PDF 원문 미리보기")
-        st.text_area("추출된 텍스트", extracted_text[:800000], height=400)
+        tabs = st.tabs([d["name"] for d in documents])
+        for tab, d in zip(tabs, documents):
+            with tab:
+                if d["skipped_pages"]:
+                    st.warning(
+                        f"분석 시간 제한을 넘은 페이지({page_list(d['skipped_pages'])})를 건너뛰어 "
+                        "본문 일부가 빠졌습니다. 구조화할 때 포함 여부를 선택할 수 있습니다."
+                    )
+                st.text_area("추출된 텍스트", d["preview"], height=400, key=f"preview_{d['hash']}")
 
 # ----------- (2) AI 분석 -----------
 with col2:
-    if st.session_state.get("extracted_text"):
-        cleaned_text = clean_text_for_ai(st.session_state["extracted_text"])
+    if st.session_state.get("documents"):
+        documents = st.session_state["documents"]
+        # 일부 페이지를 건너뛴 파일은 사용자가 고른 경우에만 구조화·저장
+        # (저장 문서에 _skipped_pages를 남겨 나중에 찾아 다시 처리할 수 있게 함)
+        partial_count = sum(bool(d["skipped_pages"]) for d in documents)
+        include_partial = partial_count > 0 and st.checkbox(
+            f"일부 페이지를 읽지 못한 파일 {partial_count}건도 구조화·저장"
+        )
 
         if st.button("AI로 구조화(JSON) 변환"):
-            with st.spinner("AI가 문서를 분석 중입니다..."):
-                try:
-                    completion = client.beta.chat.completions.parse(
-    model=MODEL_GPT,
-    messages=[
-        {
-            "role": "system",
-            "content": (
-                "You are an expert in Korean audit report parsing. "
-                "You must convert unstructured text into structured JSON according to the schema."
-            ),
-        },
-        {
-            "role": "user",
-            "content": (
-                f"{cleaned_text}\n\n"
-                "다음 조건을 지켜 감사결과를 JSON으로 구조화하세요:\n"
-                "1) 상위 제목과 세부 제목을 구분하세요.\n"
-                "   - '○○ 분야', '건강관리 분야', '예산·회계 분야'처럼 '분야'로 끝나는 것은 **분야**입니다.\n"
-                "   - '15 ○○○○센터 비품관리대장 관리 소홀 [시정]'처럼 번호 + 제목 + [처분] 형태는\n"
-                "     번호를 제외한 부분을 **건명**으로 사용합니다.\n"
-                "2) JSON 필드는 다음과 같습니다.\n"
-                "   - '분야': '예산·회계', '건강관리', '보건위생' 등 상위 분야 이름(예: '건강관리 분야' → '건강관리').\n"
-                "   - '건명': 각 지적사항의 구체적인 제목\n"
-                "       예) '특별휴가 사용 관리 소홀', '○○센터 비품관리대장 관리 소홀' 등.\n"
-                "       '예산·회계 분야', '건강관리 분야'처럼 상위 제목은 건명에 절대 넣지 마세요.\n"
-                "   - '처분': '시정', '주의', '통보', '시정/주의/통보' 등.\n"
-                "   - '관련규정': 해당 지적사항 아래 '관련규정' 항목 전체 (요약 금지).\n"
-                "   - '지적사항': 해당 지적사항 아래 '지적사항' 및 '조치할 사항' 내용을 자연스럽게 연결한 문단.\n"
-                "3) JSON 전체 구조는 다음과 같습니다.\n"
-                "{ '감사연도': str,\n"
-                "  '피감기관': str,\n"
-                "  '감사결과': [\n"
-                "    { '분야': str, '건명': str, '처분': str, '관련규정': str, '지적사항': str }, ...\n"
-                "  ]\n"
-                "}\n"
-            ),
-        },
-    ],
-    response_format=ResearchPaperExtraction,
-)
+            # 이미 저장됐거나 저장 대기 중인 파일은 AI 요청을 다시 보내지 않음
+            known = stored_hashes(d["hash"] for d in documents)
+            known.update(doc["_id"] for doc in st.session_state["pending_docs"])
+            targets = [
+                d for d in documents
+                if d["hash"] not in known and (include_partial or not d["skipped_pages"])
+            ]
+            skipped = sum(d["hash"] in known for d in documents)
+            if skipped:
+                st.info(f"이미 저장되었거나 저장 대기 중인 파일 {skipped}건은 건너뜁니다.")
+            excluded = [
+                d["name"] for d in documents
+                if d["skipped_pages"] and not include_partial and d["hash"] not in known
+            ]
+            if excluded:
+                st.warning(f"본문 일부가 빠져 제외한 파일: {', '.join(excluded)}")
 
-                    structured = completion.choices[0].message.parsed
-                    st.session_state["structured_json"] = structured
+            def show_progress(i, received):
+                placeholders[i].caption(f"{targets[i]['name']}: 응답 수신 중... ({received:,}자)")
 
-                    st.success("✅ AI 구조화 완료!")
-                    st.json(structured.model_dump())
+            def show_outcome(i, outcome):
+                # 끝난 문서부터 바로 표시 (전체 완료를 기다리지 않음)
+                with placeholders[i].container():
+                    if isinstance(outcome, Exception):
+                        st.error(f"{targets[i]['name']}: AI 처리 중 오류 발생: {outcome}")
+                    else:
+                        st.caption(targets[i]["name"])
+                        # 한 번만 직렬화해 그대로 표시 (st.json의 재직렬화 생략)
+                        st.code(orjson.dumps(outcome, option=orjson.OPT_INDENT_2).decode(), language="json")
 
-                except Exception as e:
-                    st.error(f"AI 처리 중 오류 발생: {e}")
+            if targets:
+                with st.status(f"AI가 문서 {len(targets)}건을 분석 중입니다...", expanded=True) as status:
+                    # 문서별 자리를 미리 만들어 두고 진행 상황 → 결과 순으로 교체
+                    placeholders = [st.empty() for _ in targets]
+                    outcomes = [cached_ai_result(d["hash"]) for d in targets]
+                    for i, outcome in enumerate(outcomes):
+                        if outcome is not None:
+                            show_outcome(i, outcome)
 
-        if st.session_state.get("structured_json"):
-            if st.button("MongoDB 저장"):
-                doc = st.session_state["structured_json"].model_dump()
-                collection.insert_one(doc)
-                st.success("✅ MongoDB에 저장 완료!")
+                    # 캐시에 없는 문서만 요청 (콜백의 순번을 targets 기준으로 되돌림)
+                    missing = [i for i, outcome in enumerate(outcomes) if outcome is None]
+                    if missing:
+                        results = asyncio.run(parse_all(
+                            [prepare_for_ai(targets[i]["text"]) for i in missing],
+                            on_done=lambda j, outcome: show_outcome(missing[j], outcome),
+                            on_progress=lambda j, received: show_progress(missing[j], received),
+                        ))
+                        for i, outcome in zip(missing, results):
+                            outcomes[i] = outcome
+                            if not isinstance(outcome, Exception):
+                                remember_ai_result(targets[i]["hash"], outcome)
 
-#---------- (3) 검색 -----------
+                    succeeded = 0
+                    for d, outcome in zip(targets, outcomes):
+                        if isinstance(outcome, Exception):
+                            continue
+                        doc = dict(outcome)
+                        doc["_id"] = d["hash"]
+                        doc["_search_blob"] = build_search_blob(doc)
+                        if d["skipped_pages"]:
+                            doc["_skipped_pages"] = d["skipped_pages"]
+                        st.session_state["pending_docs"].append(doc)
+                        succeeded += 1
+
+                    status.update(
+                        label=f"AI 구조화 완료 ({succeeded}/{len(targets)}건)",
+                        state="complete" if succeeded else "error",
+                    )
+
+                if succeeded:
+                    st.success(f"✅ AI 구조화 완료! ({succeeded}/{len(targets)}건)")
+
+        pending_docs = st.session_state["pending_docs"]
+        if pending_docs:
+            if st.button(f"MongoDB에 모두 저장 ({len(pending_docs)}건)"):
+                # 한 번의 요청으로 일괄 저장. ordered=False면 일부 실패해도 나머지는 계속 저장
+                inserted = save_documents(pending_docs)
+                run_search.clear()
+                st.session_state["pending_docs"] = []
+                st.success(f"✅ MongoDB에 저장 완료! (신규 {inserted}건)")
+
+#---------- (3) 일괄 처리 (Batch) -----------
 st.markdown("---")
-st.subheader("MongoDB 검색")
+st.subheader("📦 대량 일괄 처리 (OpenAI Batch API)")
+st.caption("과거 감사결과 PDF를 한꺼번에 등록할 때 사용합니다. 비용이 절반이며 결과는 최대 24시간 내에 완료됩니다.")
 
-search_query = st.text_input("검색어를 입력하세요:")
+batch_files = st.file_uploader(
+    "일괄 처리할 PDF 파일들", type="pdf", accept_multiple_files=True, key="batch_uploader"
+)
+batch_include_partial = bool(batch_files) and st.checkbox(
+    "일부 페이지를 읽지 못한 파일도 배치에 포함", key="batch_include_partial"
+)
+if batch_files and st.button("배치 작업 생성"):
+    with st.spinner("PDF를 추출하고 배치 작업을 등록하는 중입니다..."):
+        try:
+            batch_docs, extract_failed = extract_texts(batch_files)
+            # 추출에 실패한 파일만 알리고 나머지는 그대로 등록
+            for name, e in extract_failed:
+                st.error(f"{name}: PDF 텍스트 추출 중 오류 발생: {e}")
+            # 이미 저장된 파일은 배치에서 제외
+            stored = stored_hashes(d["hash"] for d in batch_docs)
+            batch_docs = [d for d in batch_docs if d["hash"] not in stored]
+            if stored:
+                st.info(f"이미 저장된 파일 {len(stored)}건은 제외합니다.")
+            partial = [d for d in batch_docs if d["skipped_pages"]]
+            if partial and not batch_include_partial:
+                batch_docs = [d for d in batch_docs if not d["skipped_pages"]]
+                st.warning(
+                    "본문 일부가 빠져 제외한 파일: "
+                    + ", ".join(f"{d['name']}({page_list(d['skipped_pages'])})" for d in partial)
+                )
+            if batch_docs:
+                st.session_state["batch_id"] = submit_batch(batch_docs)
+                st.success(f"✅ 배치 작업 등록 완료: {st.session_state['batch_id']}")
+        except Exception as e:
+            st.error(f"배치 작업 등록 중 오류 발생: {e}")
 
-if search_query:    # ← 여기 안에서만 total_matched를 만들어야 한다!
-    regex = re.compile(search_query, re.IGNORECASE)
+batch_id = st.text_input("배치 작업 ID", value=st.session_state["batch_id"])
+if batch_id and st.button("배치 상태 확인 / 결과 저장"):
+    try:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        st.info(
+            f"상태: {batch.status}"
+            + (f" (완료 {counts.completed} / 실패 {counts.failed} / 전체 {counts.total})" if counts else "")
+        )
+        if batch_id in st.session_state["saved_batches"]:
+            st.info("이미 MongoDB에 저장된 배치입니다.")
+        elif batch.status == "completed" and (batch.output_file_id or batch.error_file_id):
+            docs, failed = load_batch_results(batch.output_file_id, batch.error_file_id)
+            if docs:
+                inserted = save_documents(docs)
+                run_search.clear()
+                st.success(f"✅ {inserted}건을 MongoDB에 저장 완료!")
+            st.session_state["saved_batches"].add(batch_id)
+            if failed:
+                st.warning(f"구조화에 실패한 파일: {', '.join(failed)}")
+    except Exception as e:
+        st.error(f"배치 처리 중 오류 발생: {e}")
 
-    query = {
-        "감사결과": {
-            "$elemMatch": {
-                "$or": [
-                    {"건명": {"$regex": search_query, "$options": "i"}},
-                    {"처분": {"$regex": search_query, "$options": "i"}},
-                    {"관련규정": {"$regex": search_query, "$options": "i"}},
-                    {"지적사항": {"$regex": search_query, "$options": "i"}},
-                ]
-            }
-        }
-    }
+#---------- (4) 검색 -----------
+st.markdown("---")
+st.subheader("MongoDB 검색")
+
+# 입력할 때마다가 아니라 [검색]을 눌렀을 때만 조회하고, 마지막 검색 조건은 세션에 보관
+with st.form("search_form"):
+    query_input = st.text_input("검색어를 입력하세요:")
+    mode_input = st.radio(
+        "검색 방식",
+        ["단어", "포함", "접두"],
+        horizontal=True,
+        help="단어: 텍스트 인덱스로 단어 단위 검색 / 포함: 검색어가 들어간 문서(부분 일치) / "
+             "접두: 필드가 검색어로 시작하는 항목(대소문자 구분, 인덱스 사용)",
+    )
+    if st.form_submit_button("검색"):
+        st.session_state["search"] = (query_input, mode_input)
 
-    results = list(collection.find(query))
+search_query, search_mode = st.session_state["search"]
 
+if search_query:    # ← 여기 안에서만 total_matched를 만들어야 한다!
     total_matched = 0
     display_blocks = []
+    truncated = False
 
-    for doc in results:
-        matched_items = []
-        for r in doc.get("감사결과", []):
-            text_fields = [
-                r.get("건명", ""),
-                r.get("처분", ""),
-                r.get("관련규정", ""),
-                r.get("지적사항", ""),
-            ]
-            if any(regex.search(str(t)) for t in text_fields):
-                matched_items.append(r)
-
-        if matched_items:
-            total_matched += len(matched_items)
-            display_blocks.append((doc, matched_items))
+    # 사용자 입력은 항상 이스케이프해 정규식으로 해석되지 않게 하고(역추적 폭주 방지),
+    # 서버 작업 시간에 상한을 둔다
+    try:
+        total_matched, display_blocks, truncated, fell_back = run_search(search_query, search_mode)
+        if fell_back and display_blocks:
+            st.caption("단어 검색 결과가 없어 부분 일치로 검색했습니다.")
+    except ExecutionTimeout:
+        st.warning("검색 시간이 초과되었습니다. 검색어를 더 구체적으로 입력하거나 '접두' 방식을 사용해 보세요.")
 
     # -----------------------
     # 여기가 결과 출력 시작지점
     # -----------------------
     if total_matched > 0:
-        st.success(f"총 {total_matched}건의 결과가 검색되었습니다.")
+        if truncated:
+            # 문서 수 상한에 걸린 경우: 전체 건수가 아님을 분명히 알림
+            st.warning(
+                f"일치하는 문서가 너무 많아 앞쪽 {len(display_blocks)}개 문서의 "
+                f"{total_matched}건만 표시합니다. 검색어를 더 구체적으로 입력해 주세요."
+            )
+        else:
+            st.success(f"총 {total_matched}건의 결과가 검색되었습니다.")
+
+        # 결과 문서를 한 화면에 모두 그리지 않고 페이지 단위로 표시
+        # (조회 결과는 run_search에 캐시되어 페이지를 넘겨도 DB를 다시 조회하지 않음)
+        pages = -(-len(display_blocks) // RESULTS_PER_PAGE)
+        page = 1
+        if pages > 1:
+            page = st.number_input(
+                f"페이지 (전체 {pages}쪽)", min_value=1, max_value=pages, value=1, step=1,
+                key=f"page_{search_mode}_{search_query}",
+            )
+        start = (page - 1) * RESULTS_PER_PAGE
 
-        for idx, (doc, items) in enumerate(display_blocks, start=1):
+        for idx, (doc, items) in enumerate(
+            display_blocks[start:start + RESULTS_PER_PAGE], start=start + 1
+        ):
             st.markdown(f"### {idx}. {doc.get('피감기관')} ({doc.get('감사연도')})")
 
             for r in items:
@@ -301,3 +1055,8 @@ if search_query:    # ← 여기 안에서만 total_matched를 만들어야 한
                 st.markdown("---")
     else:
         st.info("검색 결과가 없습니다.")
+
+# 추출이 진행 중이면 나머지 화면(검색 등)을 모두 그린 뒤 잠시 후 다시 확인
+if extraction_pending:
+    time.sleep(0.5)
+    st.rerun()
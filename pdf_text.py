@@ -0,0 +1,155 @@
+import fitz  # PyMuPDF
+import contextlib
+import io
+import re
+import signal
+import threading
+
+# -----------------------------
+# PDF 텍스트 추출 함수
+# (프로세스 풀 워커에서 import해 쓰므로 Streamlit에 의존하지 않는 별도 모듈)
+# -----------------------------
+def _iter_pages(doc):
+    try:
+        for page in doc:
+            yield page.get_text("text")
+    finally:
+        doc.close()
+
+PDFMINER_PAGE_TIMEOUT = 10   # pdfminer 대체 경로에서 한 페이지에 허용하는 최대 분석 시간(초)
+
+# pdfminer 내부의 except Exception에 삼켜지지 않도록 BaseException에서 파생
+# (타이머는 한 번만 울리므로 삼켜지면 그 페이지는 제한 없이 계속 분석됨)
+class _PageTimeout(BaseException):
+    pass
+
+def _raise_page_timeout(signum, frame):
+    raise _PageTimeout
+
+@contextlib.contextmanager
+def _time_limit(seconds: float):
+    # SIGALRM으로 실행 중인 분석 자체를 중단 (스레드와 달리 작업이 뒤에서 계속 돌지 않음)
+    # 시그널은 메인 스레드에서만 받을 수 있으므로, 프로세스 풀 워커가 아닌 곳이나
+    # SIGALRM이 없는 OS(Windows)에서는 제한 없이 실행
+    if not hasattr(signal, "SIGALRM") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous = signal.signal(signal.SIGALRM, _raise_page_timeout)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+def _iter_pages_pdfminer(pdf_bytes: bytes, page_timeout: float = PDFMINER_PAGE_TIMEOUT):
+    # MuPDF가 열지 못하는 PDF용 대체 경로 (느리지만 손상된 파일에 더 관대함)
+    # 전체 문서를 한 문자열로 만들지 않고 페이지를 분석하는 대로 하나씩 돌려줌
+    # 손상된 그래픽 스트림 등으로 시간 제한을 넘긴 페이지는 건너뛰고 None을 돌려줌
+    # 중단된 페이지는 장치(device)에 그리던 도형(Form XObject 등)의 상태가 남아
+    # 다음 페이지의 end_page에서 AssertionError가 나므로, 장치·인터프리터는 페이지마다 새로 만듦
+    from pdfminer.converter import PDFPageAggregator
+    from pdfminer.layout import LAParams, LTTextContainer
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+    rsrcmgr = PDFResourceManager()
+    for page in PDFPage.get_pages(io.BytesIO(pdf_bytes)):
+        device = PDFPageAggregator(rsrcmgr, laparams=LAParams())
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        try:
+            with _time_limit(page_timeout):
+                interpreter.process_page(page)
+                layout = device.get_result()
+        except _PageTimeout:
+            yield None
+            continue
+        yield "".join(
+            element.get_text() for element in layout if isinstance(element, LTTextContainer)
+        )
+
+def iter_page_text(pdf_bytes: bytes):
+    # PyMuPDF(C 라이브러리)로 추출: pdfminer 대비 수 배 빠름
+    # bytes를 그대로 넘겨 BytesIO 래핑·read() 복사 없이 열고, 한 페이지씩 돌려줌
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    except RuntimeError:  # fitz.FileDataError 등 파싱 실패
+        return _iter_pages_pdfminer(pdf_bytes)
+    return _iter_pages(doc)
+
+# -----------------------------
+# 텍스트 정제 함수 (표·연번 제거)
+# -----------------------------
+# 건너뛸 줄의 형태를 하나의 여러 줄(multiline) 정규식으로 합쳐
+# 파이썬 줄 단위 루프 없이 re.sub 한 번으로 정제
+#   - 빈 줄, 구분선(테이블 테두리 등): ─, │, ┃, ┏, ┓, ┗, ┛, =, - 등으로만 이루어진 줄
+#   - 페이지 번호: "15 / 32", 짧은(8자 이하) "- 15 -", "15"
+#   - 표 캡션: "표 1", "표 2-1", "Table 1" 등 ("table"이 들어간 줄 전체)
+#   - 내용 없는 순번: "1." / "2)" / "1. 가" / "2) 나"
+#   ⛔ "5. 건강관리 분야", "15 ○○센터 비품관리대장…" 같은 실제 제목/건명 줄은 유지됨
+# (줄바꿈을 넘어가지 않도록 공백은 [^\S\n]으로 한정)
+_LINE_BREAK_RE = re.compile(r"\r\n|[\r\x0b\x0c\x1c-\x1e\x85\u2028\u2029]")
+_SKIP_LINE_RE = re.compile(
+    r"^(?:"
+    r"(?:[^\S\n]|[│┃┏┓┗┛━═\-_=])*"
+    r"|(?:[^\S\n]|[\-–—])*\d+[^\S\n]*/[^\S\n]*\d+(?:[^\S\n]|[\-–—])*"
+    r"|[^\S\n]*(?=[\-–—\d](?:[^\n]{0,6}[\-–—\d])?[^\S\n]*$)(?:[^\S\n]|[\-–—])*\d+(?:[^\S\n]|[\-–—])*"
+    r"|[^\S\n]*표[^\S\n]*\d[^\n]*"
+    r"|[^\n]*table[^\n]*"
+    r"|[^\S\n]*\d{1,2}[^\S\n]*[.)][^\S\n]*[가-힣]?[^\S\n]*"
+    r")$\n?",
+    re.I | re.M,
+)
+
+def clean_text_for_ai(text: str) -> str:
+    text = _LINE_BREAK_RE.sub("\n", text)
+    return _SKIP_LINE_RE.sub("", text).rstrip("\n")
+
+def extract_for_ai(pdf_bytes: bytes, preview_chars: int,
+                   focus_min_chars: int | None = None) -> tuple[str, str, list[int]]:
+    # 페이지 단위로 추출하면서 바로 정제해, 문서 전체 원문을 한꺼번에 들고 있지 않음
+    # (정제는 줄 단위라 페이지별로 해도 결과가 같음). 원문은 미리보기 분량만 보관
+    # 반환값: (원문 미리보기, 정제된 본문, 시간 제한으로 건너뛴 페이지 번호(1부터))
+    preview, preview_len = [], 0
+    cleaned = []
+    skipped_pages = []
+    for i, page_text in enumerate(iter_page_text(pdf_bytes)):
+        if page_text is None:   # 시간 제한으로 건너뛴 페이지
+            skipped_pages.append(i + 1)
+            continue
+        if preview_len < preview_chars:
+            part = ("\n" if i else "") + page_text
+            preview.append(part[:preview_chars - preview_len])
+            preview_len += len(preview[-1])
+        page_cleaned = clean_text_for_ai(page_text)
+        if page_cleaned:
+            cleaned.append(page_cleaned)
+    text = "\n".join(cleaned)
+    # 긴 문서는 감사결과와 무관한 부분을 여기(워커 프로세스)에서 덜어냄
+    if focus_min_chars is not None and len(text) > focus_min_chars:
+        text = focus_audit_text(text)
+    return "".join(preview), text, skipped_pages
+
+# -----------------------------
+# 감사결과 관련 부분만 남기기 (표지·목차·부록 등 제거)
+# -----------------------------
+# 처분 종류·항목 제목이 들어간 줄과 그 앞뒤 context줄만 남김
+# 지적사항 본문은 여러 줄로 이어지므로 context는 넉넉하게 두고,
+# 감사연도·피감기관이 나오는 앞부분(head줄)은 항상 유지
+_AUDIT_KEY_RE = re.compile(
+    r"시정|주의|통보|회수|추징|추급|환급|징계|훈계|경고|분야|지적사항|관련규정|조치할"
+)
+
+def focus_audit_text(text: str, context: int = 30, head: int = 40) -> str:
+    lines = text.split("\n")
+    keep = [False] * len(lines)
+    keep[:head] = [True] * min(head, len(lines))
+    found = False
+    for i, line in enumerate(lines):
+        if _AUDIT_KEY_RE.search(line):
+            found = True
+            for j in range(max(0, i - context), min(len(lines), i + context + 1)):
+                keep[j] = True
+    if not found:
+        # 형식이 다른 문서일 수 있으므로 아무것도 덜어내지 않음
+        return text
+    return "\n".join(line for line, k in zip(lines, keep) if k)